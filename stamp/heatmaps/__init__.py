@@ -1,6 +1,7 @@
 import argparse
 import logging
 from collections.abc import Collection
+from concurrent import futures
 from pathlib import Path
 from typing import cast
 
@@ -9,42 +10,56 @@ import matplotlib.pyplot as plt
 import numpy as np
 import openslide
 import torch
-from fastai.vision.learner import Learner, load_learner
+from fastai.vision.learner import load_learner
 from jaxtyping import Float, Int
 from matplotlib.axes import Axes
+from matplotlib.figure import Figure
 from matplotlib.patches import Patch
 from PIL import Image
-from torch import Tensor
+from torch import Tensor, nn
+from torch._prims_common import DeviceLikeType
 from torch.func import jacrev  # pyright: ignore[reportPrivateImportUsage]
 
-from stamp.preprocessing.extract import supported_extensions
+from stamp.preprocessing.extract import find_slides
 from stamp.preprocessing.tiling import get_slide_mpp
 
 logger = logging.getLogger("stamp")
 
+# RGBA lookup table of the colormap used for the category scores,
+# so we don't have to go through `Colormap.__call__` for every single pixel
+rdbu_lut = plt.get_cmap("RdBu")(np.arange(256), bytes=True)
+
 
 def get_stride(coords: Tensor) -> float:
-    xs = coords[:, 0].unique(sorted=True)
-    stride = (xs[1:] - xs[:-1]).min()
-    return stride
-
-
-def gradcam_per_category(learn: Learner, feats: Tensor) -> Tensor:
-    tile, feat = -2, -1  # feats dimensions
-
-    return (
-        (
-            feats
-            * jacrev(
-                lambda x: torch.softmax(
-                    learn.model(x.unsqueeze(0), torch.tensor([x.shape[tile]])),
-                    dim=1,
-                ).squeeze(0)
-            )(feats)
-        )
-        .mean(feat)
-        .abs()
-    )
+    return torch.diff(torch.unique(coords[:, 0])).min().item()
+
+
+def gradcam_per_category(
+    model: nn.Module, feats: Float[Tensor, "n_tiles d_feats"]
+) -> tuple[Float[Tensor, "n_categories n_tiles"], Float[Tensor, "n_categories"]]:
+    """Calculates the gradcam of each tile, as well as the bag's prediction
+
+    Returns:
+        The gradcam per category and tile and the softmaxed prediction of the bag.
+        The prediction is a by-product of the jacobian calculation,
+        so we return it instead of running another forward pass.
+    """
+    tile = -2  # feats dimensions
+    lens = torch.tensor([feats.shape[tile]], device=feats.device)
+
+    def bag_probs(
+        x: Float[Tensor, "n_tiles d_feats"],
+    ) -> tuple[Float[Tensor, "n_categories"], Float[Tensor, "n_categories"]]:
+        probs = torch.softmax(model(x.unsqueeze(0), lens), dim=1).squeeze(0)
+        return probs, probs
+
+    # The jacobian only has one row per category (i.e. it is of shape
+    # [n_categories, n_tiles, d_feats]), and jacrev already vmaps the backward
+    # passes over those rows.  Contract it with the features directly instead of
+    # materializing their elementwise product.
+    jac, probs = jacrev(bag_probs, has_aux=True)(feats)
+    gradcam = torch.einsum("ctd,td->ct", jac, feats).div(feats.shape[-1]).abs()
+    return gradcam, probs
 
 
 def vals_to_im(
@@ -53,13 +68,10 @@ def vals_to_im(
 ):
     """Arranges scores in a 2d grid according to coordinates"""
     size = norm_coords.max(0).values.flip(0) + 1
-    im = torch.zeros((*size.tolist(), *scores.shape[1:]))
-
-    flattened_im = im.flatten(end_dim=1)
-    flattened_coords = norm_coords[:, 1] * im.shape[1] + norm_coords[:, 0]
-    flattened_im[flattened_coords] = scores
-
-    im = flattened_im.reshape_as(im)
+    im = torch.zeros(
+        (*size.tolist(), *scores.shape[1:]), dtype=scores.dtype, device=scores.device
+    )
+    im[norm_coords[:, 1], norm_coords[:, 0]] = scores
 
     return im
 
@@ -142,73 +154,94 @@ def heatmaps_(
     wsi_dir: Path,
     checkpoint_path: Path,
     output_dir: Path,
+    device: DeviceLikeType = "cuda" if torch.cuda.is_available() else "cpu",
+    use_bf16: bool = False,
 ) -> None:
+    device = torch.device(device)
+    if use_bf16 and device.type == "cuda" and not torch.cuda.is_bf16_supported():
+        logger.warning(f"{device} does not support bfloat16, using float32 instead")
+        use_bf16 = False
+
     learn = load_learner(checkpoint_path)
-    learn.model.eval()
+    learn.model.to(device).eval()
     categories: Collection[str] = learn.dls.train.dataset._datasets[
         -1
     ].encode.categories_[0]
 
-    for wsi_path in (
-        p for ext in supported_extensions for p in wsi_dir.glob(f"**/*{ext}")
-    ):
-        h5_path = feature_dir / wsi_path.with_suffix(".h5").name
-
-        if not h5_path.exists():
-            logger.info(f"could not find matching h5 file at {h5_path}. Skipping...")
-            continue
-
-        slide_output_dir = output_dir / h5_path.stem
-        slide_output_dir.mkdir(exist_ok=True, parents=True)
-        logger.info(f"creating heatmaps for {wsi_path.name}")
-        with h5py.File(h5_path) as h5:
-            feats = torch.tensor(
-                h5["feats"][:]  # pyright: ignore[reportIndexIssue]
-            ).float()
-            coords = torch.tensor(h5["coords"][:])  # pyright: ignore[reportIndexIssue]
-
-            stride = cast(float, h5.attrs.get("tile_size", get_stride(coords)))
-
-        preds = torch.softmax(
-            learn.model(feats.unsqueeze(0), torch.tensor([feats.shape[-2]])),
-            dim=1,
-        ).squeeze(0)
-
-        gradcam = gradcam_per_category(
-            learn=learn,
-            feats=feats,
-        )
-        gradcam_2d = vals_to_im(
-            gradcam.permute(-1, -2),
-            (coords // stride).long(),
-        ).detach()
-
-        scores = torch.softmax(
-            learn.model(feats.unsqueeze(-2), torch.ones((len(feats)))), dim=1
-        )
-        scores_2d = vals_to_im(
-            scores, torch.div(coords, stride, rounding_mode="floor").long()
-        ).detach()
-        fig, axs = plt.subplots(nrows=2, ncols=max(2, len(categories)), figsize=(12, 8))
-
-        show_class_map(
-            class_ax=axs[0, 1],
-            top_score_indices=scores_2d.topk(2).indices[:, :, 0],
-            gradcam_2d=gradcam_2d,
-            categories=categories,
-        )
-
-        slide = openslide.open_slide(wsi_path)
-
-        for ax, (pos_idx, category) in zip(axs[1, :], enumerate(categories)):
-            ax: Axes
-            topk = scores_2d.topk(2)
+    # Encoding and writing the images is offloaded to a thread pool,
+    # so it can overlap with the next slide's inference
+    with futures.ThreadPoolExecutor(max_workers=4) as encoder:
+        pending: list[futures.Future] = []
+        for wsi_path in find_slides(wsi_dir):
+            h5_path = feature_dir / wsi_path.with_suffix(".h5").name
+
+            if not h5_path.exists():
+                logger.info(
+                    f"could not find matching h5 file at {h5_path}. Skipping..."
+                )
+                continue
+
+            slide_output_dir = output_dir / h5_path.stem
+            slide_output_dir.mkdir(exist_ok=True, parents=True)
+            logger.info(f"creating heatmaps for {wsi_path.name}")
+            with h5py.File(h5_path) as h5:
+                feats_ds = cast(h5py.Dataset, h5["feats"])
+                # read the features directly into a (pinned, so it can be copied
+                # to the GPU asynchronously) float32 buffer,
+                # letting HDF5 do the type conversion
+                feats = torch.empty(
+                    feats_ds.shape,
+                    dtype=torch.float32,
+                    pin_memory=device.type == "cuda",
+                )
+                feats_ds.read_direct(feats.numpy())
+                feats = feats.to(device, non_blocking=True)
+
+                coords_ds = cast(h5py.Dataset, h5["coords"])
+                coords_np = np.empty(coords_ds.shape, dtype=coords_ds.dtype)
+                coords_ds.read_direct(coords_np)
+                coords = torch.from_numpy(coords_np).to(device)
+
+                # only infer the stride if it wasn't saved alongside the features
+                stride = (
+                    cast(float, h5.attrs["tile_size"])
+                    if "tile_size" in h5.attrs
+                    else get_stride(coords)
+                )
+
+            # bfloat16 halves the memory traffic of the model,
+            # at the cost of slightly different heatmaps
+            with torch.autocast(device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                # jacrev does its own (functional) differentiation,
+                # so there is no need to record a graph outside of it
+                with torch.no_grad():
+                    gradcam, preds = gradcam_per_category(
+                        model=learn.model, feats=feats
+                    )
+                with torch.inference_mode():
+                    scores = torch.softmax(
+                        learn.model(
+                            feats.unsqueeze(-2),
+                            torch.ones(len(feats), dtype=torch.long, device=device),
+                        ),
+                        dim=1,
+                    )
+
+            preds = preds.float().cpu()
+            coords_norm = torch.div(coords, stride, rounding_mode="floor").long()
+            gradcam_2d = vals_to_im(gradcam.permute(-1, -2).float(), coords_norm)
+            scores_2d = vals_to_im(scores.float(), coords_norm)
+
             # Calculate the distance of the "hot" class
             # to the class with the highest score apart from the hot class
+            scores_top2 = scores_2d.topk(2)
+            is_hot = scores_top2.indices[..., :1] == torch.arange(
+                len(categories), device=scores_2d.device
+            )
             category_support = torch.where(
-                topk.indices[..., 0] == pos_idx,
-                scores_2d[..., pos_idx] - topk.values[..., 1],
-                scores_2d[..., pos_idx] - topk.values[..., 0],
+                is_hot,
+                scores_2d - scores_top2.values[..., 1:],
+                scores_2d - scores_top2.values[..., :1],
             )
 
             # So, if we have a pixel with scores (.4, .4, .2) and would want to get the heat value for the first class,
@@ -216,49 +249,100 @@ def heatmaps_(
             # But if our scores were (.4, .3, .3), it would be red,
             # because now our class is .1 above its nearest competitor
 
+            # The highest and second-highest gradcam of each tile.  For each category,
+            # the highest gradcam among the *other* categories is the first of these,
+            # unless that one belongs to the category itself.
+            gradcam_top2 = gradcam_2d.topk(2)
+            others = torch.where(
+                gradcam_top2.indices[..., :1]
+                == torch.arange(len(categories), device=gradcam_2d.device),
+                gradcam_top2.values[..., 1:],
+                gradcam_top2.values[..., :1],
+            )
             attention = torch.where(
-                topk.indices[..., 0] == pos_idx,
-                gradcam_2d[..., pos_idx] / gradcam_2d.max(),
-                (
-                    others := gradcam_2d[
-                        ..., list(set(range(len(categories))) - {pos_idx})
-                    ]
-                    .max(-1)
-                    .values
-                )
-                / others.max(),
+                is_hot,
+                gradcam_2d / gradcam_2d.max(),
+                others / others.amax(dim=(0, 1)),
+            )
+
+            category_scores = (
+                -category_support * attention / attention.amax(dim=(0, 1)) / 2 + 0.5
             )
 
-            score_im = cast(
-                np.ndarray,
-                plt.get_cmap("RdBu")(
-                    -category_support * attention / attention.max() / 2 + 0.5
-                ),
+            # Convert everything the images need to uint8 while still on the device,
+            # so only a single byte per pixel and category is copied to the host.
+            # The indices into `rdbu_lut` are mapped like `Colormap.__call__` does
+            category_score_idxs = (
+                (category_scores * len(rdbu_lut))
+                .clamp(0, len(rdbu_lut) - 1)
+                .to(torch.uint8)
+                .cpu()
+                .numpy()
+            )
+            alphas = ((attention > 0).to(torch.uint8) * 255).cpu().numpy()
+
+            # Make sure the previous slide's images have been written
+            # (and re-raise any errors that occurred while doing so)
+            for future in pending:
+                future.result()
+            pending = []
+
+            # We use a `Figure` instead of `plt.subplots`,
+            # as it can be saved from another thread without going through pyplot
+            fig = Figure(figsize=(12, 8))
+            axs = fig.subplots(nrows=2, ncols=max(2, len(categories)))
+
+            show_class_map(
+                class_ax=axs[0, 1],
+                top_score_indices=scores_top2.indices[:, :, 0].cpu(),
+                gradcam_2d=gradcam_2d,
+                categories=categories,
             )
 
-            score_im[..., -1] = attention > 0
-
-            ax.imshow(score_im)
-            ax.set_title(f"{category} {preds[pos_idx]:1.2f}")
-            target_size = np.array(score_im.shape[:2][::-1]) * 8
-            # latest PIL requires shape to be a tuple (), not array []
-            Image.fromarray(np.uint8(score_im * 255)).resize(
-                tuple(target_size), resample=Image.Resampling.NEAREST
-            ).save(
-                slide_output_dir
-                / f"scores-{h5_path.stem}--score_{category}={preds[pos_idx]:0.2f}.png"
+            slide = openslide.open_slide(wsi_path)
+
+            for ax, (pos_idx, category) in zip(axs[1, :], enumerate(categories)):
+                ax: Axes
+                score_im = rdbu_lut[category_score_idxs[..., pos_idx]]
+
+                score_im[..., -1] = alphas[..., pos_idx]
+
+                ax.imshow(score_im)
+                ax.set_title(f"{category} {preds[pos_idx]:1.2f}")
+                target_size = np.array(score_im.shape[:2][::-1]) * 8
+                # latest PIL requires shape to be a tuple (), not array []
+                score_pil = Image.fromarray(score_im).resize(
+                    tuple(target_size), resample=Image.Resampling.NEAREST
+                )
+                pending.append(
+                    encoder.submit(
+                        score_pil.save,
+                        slide_output_dir
+                        / f"scores-{h5_path.stem}--score_{category}={preds[pos_idx]:0.2f}.png",
+                    )
+                )
+
+            # Generate overview
+            thumb = show_thumb(
+                slide=slide,
+                thumb_ax=axs[0, 0],
+                attention=attention,
+            )
+            pending.append(
+                encoder.submit(
+                    Image.fromarray(thumb).save,
+                    slide_output_dir / f"thumbnail-{h5_path.stem}.png",
+                )
             )
 
-        # Generate overview
-        thumb = show_thumb(
-            slide=slide,
-            thumb_ax=axs[0, 0],
-            attention=attention,  # pyright: ignore[reportPossiblyUnboundVariable]
-        )
-        Image.fromarray(thumb).save(slide_output_dir / f"thumbnail-{h5_path.stem}.png")
+            for ax in axs.ravel():
+                ax.axis("off")
 
-        for ax in axs.ravel():
-            ax.axis("off")
+            pending.append(
+                encoder.submit(
+                    fig.savefig, slide_output_dir / f"overview-{h5_path.stem}.png"
+                )
+            )
 
-        fig.savefig(slide_output_dir / f"overview-{h5_path.stem}.png")
-        plt.close(fig)
+        for future in pending:
+            future.result()
@@ -1,9 +1,11 @@
 from pathlib import Path
 
+import torch
 from pydantic import AliasChoices, BaseModel, Field
+from torch._prims_common import DeviceLikeType
 
 
-class HeatmapConfig(BaseModel):
+class HeatmapConfig(BaseModel, arbitrary_types_allowed=True):
     output_dir: Path
 
     feature_dir: Path
@@ -11,3 +13,6 @@ class HeatmapConfig(BaseModel):
     checkpoint_path: Path = Field(
         validation_alias=AliasChoices("checkpoint_path", "model_path")
     )
+
+    device: DeviceLikeType = "cuda" if torch.cuda.is_available() else "cpu"
+    use_bf16: bool = False
@@ -6,7 +6,6 @@ from typing import Literal
 
 import torch
 import torch.nn.functional as F
-from einops import repeat
 from torch import nn
 
 
@@ -168,7 +167,7 @@ class TransMIL(nn.Module):
 
         add_cls = self.pool == "cls"
         if add_cls:
-            cls_tokens = repeat(self.cls_token, "d -> b 1 d", b=b)
+            cls_tokens = self.cls_token.expand(b, 1, -1)
             x = torch.cat((cls_tokens, x), dim=1)
             lens = lens + 1  # account for cls token
 
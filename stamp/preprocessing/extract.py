@@ -1,6 +1,7 @@
 # %%
 import hashlib
 import logging
+import os
 from collections.abc import Callable
 from functools import cache
 from pathlib import Path
@@ -45,6 +46,17 @@ supported_extensions = {
 logger = logging.getLogger("stamp")
 
 
+def find_slides(wsi_dir: Path) -> Iterator[Path]:
+    """Yields all slides with a supported extension in `wsi_dir` and its subdirectories
+
+    The directory tree is only walked once, instead of once per supported extension.
+    """
+    for dir_path, _, file_names in os.walk(wsi_dir):
+        for file_name in file_names:
+            if Path(file_name).suffix in supported_extensions:
+                yield Path(dir_path) / file_name
+
+
 @cache
 def get_preprocessing_code_hash() -> str:
     """The hash of the entire preprocessing codebase.
@@ -145,15 +157,7 @@ def extract_(
     cache_dir.mkdir(exist_ok=True)
     feat_output_dir = output_dir / extractor_id
 
-    for slide_path in (
-        progress := tqdm(
-            list(
-                slide_path
-                for extension in supported_extensions
-                for slide_path in wsi_dir.glob(f"**/*{extension}")
-            )
-        )
-    ):
+    for slide_path in (progress := tqdm(list(find_slides(wsi_dir)))):
         progress.set_description(str(slide_path.relative_to(wsi_dir)))
         logger.debug(f"processing {slide_path}")
 
@@ -1,16 +1,21 @@
 from collections.abc import Callable
+from functools import lru_cache
 from typing import cast
 
 import timm
 from PIL.Image import Image
 from timm.data import resolve_data_config
 from timm.data.transforms_factory import create_transform
-from torch import Tensor
+from torch import Tensor, nn
 
 from stamp.preprocessing.extractor import Extractor
 
 
-def uni(revision: str = "77ffbca1ee1cdcee6e87f6deebd2db8a5888c721") -> Extractor:
+@lru_cache(maxsize=4)
+def _load_model_and_transform(
+    revision: str,
+) -> tuple[nn.Module, Callable[[Image], Tensor]]:
+    """Loads the model from the hub only once per revision"""
     model = timm.create_model(
         f"hf-hub:MahmoodLab/uni@{revision}",
         pretrained=True,
@@ -21,6 +26,11 @@ def uni(revision: str = "77ffbca1ee1cdcee6e87f6deebd2db8a5888c721") -> Extractor
         Callable[[Image], Tensor],
         create_transform(**resolve_data_config(model.pretrained_cfg, model=model)),
     )
+    return model, transform
+
+
+def uni(revision: str = "77ffbca1ee1cdcee6e87f6deebd2db8a5888c721") -> Extractor:
+    model, transform = _load_model_and_transform(revision)
     return Extractor(
         model=model, transform=transform, identifier=f"mahmood-uni-{revision[:8]}"
     )